@@ -4,12 +4,14 @@ Sqlite database and exports it as daily HDF5 files.
 """
 import os
 import sys
+import time
 import h5py
 import arrow
 import socket
 import sqlite3
 import argparse
 import configobj
+import urllib.parse
 import numpy as np
 from aristoteles import __version__ as aristoteles_version
 
@@ -29,6 +31,9 @@ metric_descriptions = {
 # Metric values go in here
 metric_data = list()
 
+# Acquisition directories known to exist
+acq_dirs = set()
+
 dataset = {
     "barometer": {"type": "pressure"},
     "pressure": {"type": "pressure"},
@@ -48,6 +53,15 @@ dataset = {
     "heatindex": {"type": "temperature"},
 }
 
+# Conversions from US units, by type: metric = (value - offset) * scale
+us_conversions = {
+    "pressure": (0.0, 33.863886),  # inHg to hPa
+    "temperature": (32.0, 5.0 / 9.0),  # F to C
+    "speed": (0.0, 1.609344),  # mi/h to km/h
+    "amount": (0.0, 25.4),  # inch to mm
+    "rate": (0.0, 25.4),  # inch/hr to mm/hr
+}
+
 units = {
     "pressure": "hPa",
     "temperature": "deg C",
@@ -58,14 +72,71 @@ units = {
     "amount": "mm",
 }
 
+# Dataset names and types, in the order they appear in query results (after
+# dateTime and usUnits), the queries we make, and the dataset units.  The names are
+# grouped by type, so that the columns needing each unit conversion are
+# contiguous.  The integer columns are cast in the query so every value comes
+# back from SQLite as a float.
+_TYPE_ORDER = (
+    "pressure",
+    "temperature",
+    "speed",
+    "amount",
+    "rate",
+    "percent",
+    "direction",
+)
+_COL_NAMES = tuple(
+    sorted(dataset, key=lambda name: _TYPE_ORDER.index(dataset[name]["type"]))
+)
+_COL_TYPES = tuple(dataset[name]["type"] for name in _COL_NAMES)
+_SQL_COLS = ",".join(("CAST(dateTime AS REAL)", "CAST(usUnits AS REAL)") + _COL_NAMES)
+_SQL_SELECT = (
+    "SELECT "
+    + _SQL_COLS
+    + " FROM archive WHERE dateTime BETWEEN ? AND ? ORDER BY dateTime"
+)
+_SQL_FIRST = "SELECT dateTime FROM archive ORDER BY dateTime LIMIT 1"
+_COL_UNITS = tuple(units[type_] for type_ in _COL_TYPES)
+
+# Record type for compound datasets: one float32 field per dataset
+_COMPOUND_DTYPE = np.dtype([(name, np.float32) for name in _COL_NAMES])
+
+
+def _type_cols(type_):
+    """Slice of the query result columns with the given type"""
+    cols = [j + 2 for j, col_type in enumerate(_COL_TYPES) if col_type == type_]
+    return slice(cols[0], cols[-1] + 1)
+
+
+# Query result columns needing each kind of unit conversion
+_TYPE_COLS = {type_: _type_cols(type_) for type_ in us_conversions}
+
+# Options for the HDF5 files we write.  The latest file format has smaller
+# object headers and compact attribute storage, but needs HDF5 >= 1.10 to read.
+file_opts = {"libver": "latest", "track_order": False, "rdcc_nbytes": 4 * 1024 * 1024}
+
+# Storage options for the datasets we write.  The chunk size is one day
+# of data (288 samples), so a typical dataset is stored as a single chunk.
+dataset_opts = {"shuffle": True, "compression": "gzip", "compression_opts": 4}
+
+# Tuning for the (read-only) wview database connections: a 64 MiB page cache
+# and up to 256 MiB of memory-mapped I/O.
+sqlite_pragmas = (
+    "query_only = 1",
+    "cache_size = -65536",
+    "mmap_size = 268435456",
+    "temp_store = MEMORY",
+)
+
 # This is the absolute earliest day we're willing to entertain.
 _DAY_LIMIT = arrow.get("2000-01-01")
 
 
 def write_state(conf, value):
-    """Write tommorrow relative to value (an arrow) to state file"""
+    """Write tommorrow relative to value (a Unix time) to state file"""
     with open(conf["state_path"], "w") as f:
-        f.write(value.shift(days=1).format("YYYYMMDD"))
+        f.write(time.strftime("%Y%m%d", time.gmtime(value + 86400)))
 
 
 def read_state(conf):
@@ -87,11 +158,41 @@ def day_arg(arg):
         raise argparse.ArgumentTypeError("{0} must be of the form YYYYMMDD".format(arg))
 
     if day < _DAY_LIMIT or day > arrow.utcnow():
-        raise argeparse.ArgumentTypeError("{0} out of range".format(arg))
+        raise argparse.ArgumentTypeError("{0} out of range".format(arg))
 
     return day
 
 
+def fetch_array(cur, ncols, nrows=288):
+    """Read the rows of the executed cursor cur into an array of floats.
+
+    The array is pre-allocated with room for nrows rows, and grown as needed.
+    NULLs become NaN.
+    """
+    arr = np.empty((nrows, ncols), dtype=np.float64)
+    n = 0
+    for row in cur:
+        if n == arr.shape[0]:
+            arr = np.concatenate((arr, np.empty((max(n, 288), ncols))))
+        arr[n] = row
+        n += 1
+
+    return arr[:n]
+
+
+def convert_units(rec):
+    """Convert the rows of query results rec in US units (i.e. with non-zero
+    usUnits) to metric, in place."""
+    us = (rec[:, 1] != 0)[:, np.newaxis]
+
+    # Each type's columns are contiguous, so this works on views of rec
+    for type_, (offset, scale) in us_conversions.items():
+        cols = rec[:, _TYPE_COLS[type_]]
+        if offset:
+            np.subtract(cols, offset, out=cols, where=us)
+        np.multiply(cols, scale, out=cols, where=us)
+
+
 def add_metric(metric, value, labels=None):
     """Record a new metric value with optional label dict"""
     metric_data.append({"name": metric, "value": str(value), "labels": labels})
@@ -142,7 +243,114 @@ def prom_and_exit(conf, status):
             os.rename(path + ".new", path)
 
     # Exit
-    exit(status)
+    sys.exit(status)
+
+
+def write_dataset(group, name, data):
+    """Create dataset name in group holding the 1-d array data, stored as per
+    dataset_opts, and return it."""
+    return group.create_dataset(
+        name, data=data, chunks=(min(288, data.shape[0]),), **dataset_opts
+    )
+
+
+def day_file(conf, day, verbose=False):
+    """Return the acquisition name and file path for the UTC day starting at
+    day (a Unix time), creating the acquisition directory, if necessary."""
+    acq = "{0}Z_{1}_weather".format(
+        time.strftime("%Y%m01T000000", time.gmtime(day)), conf["instrument"]
+    )
+    basedir = os.path.join(conf["archive"], acq)
+    filepath = os.path.join(basedir, time.strftime("%Y%m%d.h5", time.gmtime(day)))
+
+    if basedir not in acq_dirs:
+        if not os.path.exists(basedir):
+            if verbose:
+                print("Creating acquisition directory: {0}".format(basedir))
+            os.makedirs(basedir, exist_ok=True)
+        acq_dirs.add(basedir)
+
+    return acq, filepath
+
+
+def write_day(filepath, acq, data, file_attrs, station_attrs, compound=False):
+    """Write the data dict to the HDF5 file filepath in acquisition acq.  The
+    file gets the global attributes in file_attrs, plus the acquisition name.
+
+    If compound is True, each station's data are written to a single compound
+    dataset, "data", with one field per weather dataset, instead of one dataset
+    per field.
+
+    Returns the number of records written.
+    """
+    basedir, filename = os.path.split(filepath)
+    lockpath = os.path.join(basedir, ".{0}.lock".format(filename))
+
+    # Create empty lock file
+    open(lockpath, "w").close()
+
+    # Create the HDF5 file and add global attributes.
+    hf = h5py.File(filepath, "w", **file_opts)
+    hf.attrs.update({**file_attrs, "acquisition_name": acq})
+
+    # Create the image map
+    img = hf.create_group("index_map")
+
+    # Create a group for each station
+    n_wrote = 0
+    station_times = list()
+    for station in data:
+        # Be there data?
+        if not data[station].shape[0]:
+            continue
+
+        # Stations usually share sample times.  If this station's times are the
+        # same as an earlier station's, hard link to those instead of writing a
+        # copy.
+        for times, time_dset in station_times:
+            if np.array_equal(times, data[station][:, 0]):
+                img["station_time_" + station] = time_dset
+                break
+        else:
+            time_dset = write_dataset(
+                img, "station_time_" + station, data[station][:, 0]
+            )
+            station_times.append((data[station][:, 0], time_dset))
+
+        gr = hf.create_group(station)
+
+        # Attributes
+        gr.attrs.update(station_attrs[station])
+
+        # Create the datasets.  Single precision is plenty for the
+        # weather data (but not for the timestamps above).
+        if compound:
+            # Each row of values is exactly one compound record
+            values = data[station][:, 2:].astype(np.float32)
+            d = write_dataset(gr, "data", values.view(_COMPOUND_DTYPE)[:, 0])
+            d.attrs.update(
+                {"axis": ["station_time_" + station], "units": list(_COL_UNITS)}
+            )
+        else:
+            # Transpose, so each dataset's values are contiguous
+            values = np.ascontiguousarray(data[station][:, 2:].T, dtype=np.float32)
+            for i in range(len(_COL_NAMES)):
+                d = write_dataset(gr, _COL_NAMES[i], values[i])
+                d.attrs.update(
+                    {
+                        "axis": ["station_time_" + station],
+                        "units": _COL_UNITS[i],
+                    }
+                )
+
+        n_wrote += data[station].shape[0]
+
+    hf.close()
+
+    # Delete the lock file
+    os.unlink(lockpath)
+
+    return n_wrote
 
 
 def entry():
@@ -191,31 +399,40 @@ def entry():
         conf = configobj.ConfigObj(arg.conf_file, raise_errors=True, file_error=True)
     except OSError as e:
         print("FATAL: error reading config file: " + repr(e.args), file=sys.stderr)
-        prom_and_exit(conf, 1)
+        sys.exit(1)
 
     for key in ("state_path", "instrument"):
         if key not in conf:
             print("FATAL: Missing configuration key: " + key, file=sys.stderr)
-            exit(1)
+            sys.exit(1)
+
+    # Write compound datasets, if asked to
+    try:
+        compound = conf.as_bool("compound_datasets")
+    except KeyError:
+        compound = False
+    except ValueError:
+        print("FATAL: compound_datasets must be true or false", file=sys.stderr)
+        sys.exit(1)
 
     # Each weather station has its own section in the config object
     stations = conf.sections
     if len(stations) < 1:
         print("FATAL: No weather stations defined.")
-        exit(1)
+        sys.exit(1)
 
     # For each station, connect to the DB and get the start date
     db = dict()
-    cur = dict()
     start_day = dict()
+    station_attrs = dict()
     for station in stations:
         # Open the database and find the earliest record
         if "db_path" not in conf[station]:
             print(
-                "FATAL: Missing configuration key: " + key + " for station " + station,
+                "FATAL: Missing configuration key: db_path for station " + station,
                 file=sys.stderr,
             )
-            exit(1)
+            sys.exit(1)
 
         if not os.access(conf[station]["db_path"], os.R_OK):
             print(
@@ -224,10 +441,15 @@ def entry():
                 ),
                 file=sys.stderr,
             )
-            exit(1)
+            sys.exit(1)
 
-        db[station] = sqlite3.connect(conf[station]["db_path"])
-        cur[station] = db[station].cursor()
+        # Open the database read-only
+        db[station] = sqlite3.connect(
+            "file:{0}?mode=ro".format(urllib.parse.quote(conf[station]["db_path"])),
+            uri=True,
+        )
+        for pragma in sqlite_pragmas:
+            db[station].execute("PRAGMA " + pragma)
 
         if arg.verbose:
             print(
@@ -236,9 +458,17 @@ def entry():
                 )
             )
 
+        # Station group attributes for the output files
+        station_attrs[station] = {
+            "wview_database": conf[station]["db_path"],
+            "longitude": float(conf[station].get("longitude", "NaN")),
+            "latitude": float(conf[station].get("latitude", "NaN")),
+            "description": conf[station].get("description", ""),
+        }
+
         # Get the start date
-        cur[station].execute("SELECT dateTime FROM archive ORDER BY dateTime LIMIT 1;")
-        start_day[station] = arrow.get(cur[station].fetchone()[0]).floor("day")
+        rows = db[station].execute(_SQL_FIRST)
+        start_day[station] = arrow.get(rows.fetchone()[0]).floor("day")
 
     # Current UTC day
     today = arrow.utcnow().floor("day")
@@ -259,16 +489,20 @@ def entry():
                 arg.reset_state = first_day
 
             # Today is tomorrow's yesterday
-            write_state(conf, arg.reset_state.shift(days=-1))
+            write_state(conf, arg.reset_state.shift(days=-1).int_timestamp)
         else:
             print("State present.  Use --force to overwrite.")
-        exit(0)
+        sys.exit(0)
 
     # Load the state
     first_day = read_state(conf)
     if first_day is None:
         print("FATAL: Bad state.  Regenerate with --reset-state.", file=sys.stderr)
-        exit(1)
+        sys.exit(1)
+
+    # There's nothing to write before the earliest record in any database
+    if first_day < min(start_day.values()):
+        first_day = min(start_day.values())
 
     add_metric("first_day", first_day.int_timestamp)
 
@@ -293,23 +527,26 @@ def entry():
         print("FATAL: archive {} not found.".format(conf["archive"]))
         prom_and_exit(conf, 1)
 
-    # For each station, count the number of data points for yesterday.
+    # The start of each day we're writing, plus the start of the day after
+    # yesterday.
+    day_starts = range(
+        first_day.int_timestamp, yesterday.shift(days=1).int_timestamp + 1, 86400
+    )
+    ncols = len(_COL_NAMES) + 2
+
+    # Fetch yesterday's records from each station and count them.
     # We should have one reading every five minutes, so:
     #
     #  1 day * 1440 minutes/day / 5 minutes = 288
     #
-    # We only continue if _all_ stations have a complete day (or if forced)
+    # We only continue if _all_ stations have a complete day (or if forced).
+    # This is checked before fetching any earlier days, so an incomplete
+    # yesterday costs one day's query, however long the backlog.
+    latest = dict()
     for station in stations:
-        cur[station].execute(
-            "SELECT COUNT() FROM archive WHERE dateTime BETWEEN ? AND ?",
-            (yesterday.int_timestamp, yesterday.ceil("day").int_timestamp),
-        )
-
-        count = cur[station].fetchone()
-        if count is None:
-            count = 0
-        else:
-            count = count[0]
+        rows = db[station].execute(_SQL_SELECT, (day_starts[-2], day_starts[-1] - 1))
+        latest[station] = fetch_array(rows, ncols)
+        count = latest[station].shape[0]
 
         add_metric("samples_yesterday", count, dict({"station": station}))
 
@@ -326,156 +563,75 @@ def entry():
                 )
                 prom_and_exit(conf, 0)
 
-    col_name = [k for k, v in dataset.items()]
-    col = ",".join(["dateTime", "usUnits"] + col_name)
+    # Fetch the data for the rest of the days we're writing from each station
+    # in one go, append yesterday's, and convert from US units, if necessary.
+    # This is split into days below: for each station, day_index holds the
+    # index of the first record at or after each of day_starts.
+    records = dict()
+    day_index = dict()
+
+    # Room for a complete set of days: one record every five minutes
+    n_rows = 288 * (len(day_starts) - 2)
+    for station in stations:
+        rows = db[station].execute(
+            _SQL_SELECT, (first_day.int_timestamp, day_starts[-2] - 1)
+        )
+        rec = np.concatenate((fetch_array(rows, ncols, n_rows), latest[station]))
+
+        convert_units(rec)
+
+        records[station] = rec
+        day_index[station] = np.searchsorted(rec[:, 0], day_starts)
+
+    # Global attributes for the files, other than the acquisition name
+    file_attrs = {
+        "git_version_tag": "aristoteles-{0}".format(aristoteles_version),
+        "system_user": os.environ["USER"],
+        "collection_server": socket.gethostname(),
+        "instrument_name": conf["instrument"],
+        "archive_version": archive_version,
+        "acquisition_type": "weather",
+    }
 
     # Loop over days
     count = 0
-    for start, stop in arrow.Arrow.span_range("day", first_day, yesterday):
+    for day, start in enumerate(day_starts[:-1]):
+        date = time.strftime("%Y-%m-%d", time.gmtime(start))
 
         # Loop over stations
         data = dict()
         have_data = False
         for station in stations:
-            cur[station].execute(
-                "SELECT "
-                + col
-                + " FROM archive WHERE dateTime BETWEEN ? AND ? ORDER BY dateTime",
-                (start.int_timestamp, stop.int_timestamp),
-            )
-            data[station] = np.asarray(cur[station].fetchall(), dtype=float)
+            lo, hi = day_index[station][day : day + 2]
+            data[station] = records[station][lo:hi]
 
             if not data[station].shape[0]:
                 if arg.verbose:
-                    print(
-                        "No data on {0} for station {1}".format(
-                            start.format("YYYY-MM-DD"), station
-                        )
-                    )
+                    print("No data on {0} for station {1}".format(date, station))
             else:
                 have_data = True
                 if arg.verbose:
                     print(
-                        "Found {0} records on {1} for station {1}".format(
-                            data[station].shape[0], start.format("YYYY-MM-DD"), station
+                        "Found {0} records on {1} for station {2}".format(
+                            data[station].shape[0], date, station
                         )
                     )
 
         if not have_data:
-            print(
-                "No data on {0} for any station, skipping".format(
-                    start.format("YYYY-MM-DD"), station
-                )
-            )
+            print("No data on {0} for any station, skipping".format(date))
             continue
 
-        # Create the file (and acq, if necessary)
-        acq = "{0}Z_{1}_weather".format(
-            start.floor("month").format("YYYYMMDDTHHmmss"), conf["instrument"]
-        )
-        basedir = os.path.join(conf["archive"], acq)
-        filename = "{0}.h5".format(start.format("YYYYMMDD"))
-        filepath = os.path.join(basedir, filename)
-        lockpath = os.path.join(basedir, ".{0}.lock".format(filename))
-
-        if not os.path.exists(basedir):
-            if arg.verbose:
-                print("Creating acquisition directory: {0}".format(basedir))
-            os.makedirs(basedir)
-
-        # Create empty lock file
-        open(lockpath, "w").close()
-
+        acq, filepath = day_file(conf, start, arg.verbose)
         if arg.verbose:
             print("Writing file {0}".format(filepath))
 
-        # Create the HDF5 file and add global attributes.
-        hf = h5py.File(filepath, "w")
-        hf.attrs.create(
-            "git_version_tag", "aristoteles-{0}".format(aristoteles_version)
-        )
-        hf.attrs.create("system_user", os.environ["USER"])
-        hf.attrs.create("collection_server", socket.gethostname())
-        hf.attrs.create("instrument_name", conf["instrument"])
-        hf.attrs.create("archive_version", archive_version)
-        hf.attrs.create("acquisition_name", acq)
-        hf.attrs.create("acquisition_type", "weather")
-
-        # Create the image map
-        img = hf.create_group("index_map")
-
-        # Create a group for each station
-        n_wrote = 0
-        for station in stations:
-            # Be there data?
-            if not data[station].shape[0]:
-                continue
-
-            # Convert from US units, if necessary
-            for i in range(data[station].shape[0]):
-                if data[station][i, 1]:
-                    for j in range(2, data[station].shape[1]):
-                        if not data[station][i, j]:
-                            continue
-                        t = dataset[col_name[j - 2]]["type"]
-                        if t == "pressure":
-                            data[station][i, j] = (
-                                data[station][i, j] * 33.863886
-                            )  # inHg to hPa
-                        elif t == "temperature":
-                            data[station][i, j] = (
-                                (data[station][i, j] - 32.0) * 5.0 / 9.0
-                            )  # F to C
-                        elif t == "speed":
-                            data[station][i, j] = (
-                                data[station][i, j] * 1.609344
-                            )  # mi/h to km/ha
-                        elif t == "amount" or t == "rate":
-                            data[station][i, j] = (
-                                data[station][i, j] * 25.4
-                            )  # inch to mm
-
-            img.create_dataset("station_time_" + station, data=data[station][:, 0])
-
-            gr = hf.create_group(station)
-
-            # Attributes
-            gr.attrs.create("wview_database", conf[station]["db_path"])
-
-            if "longitude" in conf[station]:
-                gr.attrs.create("longitude", float(conf[station]["longitude"]))
-            else:
-                gr.attrs.create("longitude", float("NaN"))
-
-            if "latitude" in conf[station]:
-                gr.attrs.create("latitude", float(conf[station]["latitude"]))
-            else:
-                gr.attrs.create("latitude", float("NaN"))
-
-            if "description" in conf[station]:
-                gr.attrs.create("description", conf[station]["description"])
-            else:
-                gr.attrs.create("description", "")
-
-            # Create the datasets.
-            for i in range(len(col_name)):
-                d = gr.create_dataset(col_name[i], data=data[station][:, i + 2])
-                d.attrs.create("axis", ["station_time_" + station])
-                d.attrs.create("units", units[dataset[col_name[i]]["type"]])
-
-            n_wrote += data[station].shape[0]
-
-        hf.close()
-
-        # Increment count of written files
-        count += 1
-
-        # Delete the lock file
-        os.unlink(lockpath)
+        n_wrote = write_day(filepath, acq, data, file_attrs, station_attrs, compound)
 
+        # Update state
         write_state(conf, start)
 
         print("Wrote {0} records to {1}".format(n_wrote, filepath))
+        count += 1
 
     # Close
     for station in stations: